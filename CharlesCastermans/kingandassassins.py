@@ -4,9 +4,14 @@
 # Version: April 29, 2016
 
 import argparse
+import copy
+import hashlib
+from itertools import combinations
 import json
+import mmap
 import random
 import socket
+import struct
 import sys
 
 from lib import game
@@ -70,9 +75,17 @@ for coord in KNIGHTS:
 # Place the villagers on the board
 # random.sample(A, len(A)) returns a list where the elements are shuffled
 # this randomizes the position of the villagers
-for villager, coord in zip(random.sample(POPULATION, len(POPULATION)), VILLAGERS):
+for villager, coord in zip(random.sample(sorted(POPULATION), len(POPULATION)), VILLAGERS):
     PEOPLE[coord[0]][coord[1]] = villager
 
+# All the candidate triples of assassins, and for each villager the bitset
+# of the triples (bit i for ASSASSINS_TRIPLES[i]) that contain him/her
+ASSASSINS_TRIPLES = tuple(frozenset(t) for t in combinations(sorted(POPULATION), 3))
+TRIPLES_WITH = {
+    villager: sum(1 << i for i, t in enumerate(ASSASSINS_TRIPLES) if villager in t)
+    for villager in POPULATION
+}
+
 KA_INITIAL_STATE = {
     'board': BOARD,
     'people': PEOPLE,
@@ -230,8 +243,8 @@ class KingAndAssassinsState(game.GameState):
         # The king has been killed
         if visible['king'] == 'dead':
             return 0
-        # All the assassins have been arrested or killed
-        if visible['killed']['assassins'] + len(set(visible['arrested']) & hidden['assassins']) == 3:
+        # All the assassins have been arrested or killed (once they are chosen)
+        if hidden['assassins'] is not None and visible['killed']['assassins'] + len(set(visible['arrested']) & hidden['assassins']) == 3:
             return 1
         return -1
 
@@ -265,8 +278,9 @@ class KingAndAssassinsState(game.GameState):
 class KingAndAssassinsServer(game.GameServer):
     '''Class representing a server for the King & Assassins game'''
 
-    def __init__(self, verbose=False):
-        super().__init__('King & Assassins', 2, KingAndAssassinsState(), verbose=verbose)
+    def __init__(self, verbose=False, host=None, port=5000):
+        super().__init__('King & Assassins', 2, KingAndAssassinsState(copy.deepcopy(KA_INITIAL_STATE)),
+                         verbose=verbose, host=host, port=port)
         self._state._state['hidden'] = {
             'assassins': None,
             'cards': random.sample(CARDS, len(CARDS))
@@ -301,11 +315,344 @@ class KingAndAssassinsServer(game.GameServer):
             raise game.InvalidMoveException('A valid move must be a dictionary')
 
 
+class AssassinsBelief:
+    '''Class representing the belief of player 1 about the hidden assassins.
+
+    The 220 candidate triples of ASSASSINS_TRIPLES are the bits of an 'alive'
+    bitset, cleared as soon as some evidence contradicts them, and each triple
+    also carries a weight updated from the movements of the villagers.
+    '''
+
+    # Likelihood ratio of a villager getting closer to the king for an assassin
+    TOWARDS_KING = 1.5
+
+    def __init__(self):
+        self._alive = (1 << len(ASSASSINS_TRIPLES)) - 1
+        self._weights = [1.0] * len(ASSASSINS_TRIPLES)
+        self._positions = None
+        self._assassins = set()
+
+    def __len__(self):
+        return bin(self._alive).count('1')
+
+    def _checkalive(self):
+        # Contradictory evidence: fall back on the weights only
+        if self._alive == 0:
+            self._alive = (1 << len(ASSASSINS_TRIPLES)) - 1
+
+    def _triples(self):
+        alive, i = self._alive, 0
+        while alive:
+            if alive & 1:
+                yield i
+            alive >>= 1
+            i += 1
+
+    def reveal(self, villager):
+        '''Keep only the triples containing the specified villager.'''
+        self._alive &= TRIPLES_WITH[villager]
+
+    def clear(self, villager):
+        '''Discard the triples containing the specified villager.'''
+        self._alive &= ~TRIPLES_WITH[villager]
+
+    def arrest(self, arrested, killed=0):
+        '''Discard the triples for which the arrests would have ended the game.
+
+        Pre: 'arrested' are the names of the arrested villagers and 'killed'
+             the number of killed assassins, the game still going on.
+        '''
+        arrested = set(arrested)
+        for i in self._triples():
+            if killed + len(arrested & ASSASSINS_TRIPLES[i]) >= 3:
+                self._alive &= ~(1 << i)
+
+    def weigh(self, villager, factor):
+        '''Multiply the weight of the triples containing the specified villager.'''
+        mask = TRIPLES_WITH[villager] & self._alive
+        for i in self._triples():
+            if mask >> i & 1:
+                self._weights[i] *= factor
+
+    def observe(self, visible):
+        '''Update the belief from the visible part of a new state of the game.
+
+        Pre: 'visible' is the visible part of a state where the game is going on.
+        Post: Villagers who vanished without being arrested have been revealed if
+              as many assassins appeared on the board,
+              the arrests have been taken into account and the villagers who moved
+              have been weighed according to their distance to the king.
+        '''
+        people = visible['people']
+        positions, assassins, king = {}, set(), None
+        for x in range(10):
+            for y in range(10):
+                if people[x][y] in POPULATION:
+                    positions[people[x][y]] = (x, y)
+                elif people[x][y] == 'assassin':
+                    assassins.add((x, y))
+                elif people[x][y] == 'king':
+                    king = (x, y)
+        if self._positions is not None:
+            # Assassins cannot move, so that a villager may have moved before being
+            # revealed; villagers may also vanish without being revealed (see 'kill')
+            vanished = [v for v in self._positions if v not in positions and v not in visible['arrested']]
+            if len(vanished) > 0 and len(vanished) == len(assassins - self._assassins):
+                for villager in vanished:
+                    self.reveal(villager)
+            for villager, (x, y) in self._positions.items():
+                if villager in positions and king is not None and positions[villager] != (x, y):
+                    nx, ny = positions[villager]
+                    before = abs(x - king[0]) + abs(y - king[1])
+                    after = abs(nx - king[0]) + abs(ny - king[1])
+                    if after < before:
+                        self.weigh(villager, self.TOWARDS_KING)
+                    elif after > before:
+                        self.weigh(villager, 1 / self.TOWARDS_KING)
+        self.arrest(visible['arrested'], visible['killed']['assassins'])
+        self._positions = positions
+        self._assassins = assassins
+        # Keep the weights in a safe range
+        top = max((self._weights[i] for i in self._triples()), default=1.0)
+        self._weights = [w / top for w in self._weights]
+
+    def marginals(self):
+        '''Get the probability of being an assassin for every villager.
+
+        Pre: -
+        Post: The returned value is a dictionary mapping the name of each villager
+              to his/her probability of being an assassin.
+        '''
+        self._checkalive()
+        result = dict.fromkeys(POPULATION, 0.0)
+        total = 0.0
+        for i in self._triples():
+            w = self._weights[i]
+            total += w
+            for villager in ASSASSINS_TRIPLES[i]:
+                result[villager] += w
+        if total > 0:
+            for villager in result:
+                result[villager] /= total
+        return result
+
+    def sample(self, n=1, rng=random):
+        '''Draw 'n' triples of assassins according to the belief.
+
+        Pre: -
+        Post: The returned value is a list of 'n' sets of three villagers' names.
+        '''
+        self._checkalive()
+        triples = list(self._triples())
+        weights = [self._weights[i] for i in triples]
+        return [set(ASSASSINS_TRIPLES[i]) for i in rng.choices(triples, weights, k=n)]
+
+
+def checkbelief():
+    '''Check the invariants of AssassinsBelief.
+
+    Pre: -
+    Post: The returned value is the number of checks done.
+    Raises AssertionError: If the belief does not behave as expected.
+    '''
+    full = (1 << len(ASSASSINS_TRIPLES)) - 1
+    checks = [
+        len(ASSASSINS_TRIPLES) == 220,
+        all(bin(TRIPLES_WITH[v]).count('1') == 55 for v in POPULATION),
+        all(sum(TRIPLES_WITH[v] >> i & 1 for v in POPULATION) == 3 for i in range(220)),
+        all(ASSASSINS_TRIPLES[i] == {v for v in POPULATION if TRIPLES_WITH[v] >> i & 1} for i in range(220))
+    ]
+    belief = AssassinsBelief()
+    checks.append(len(belief) == 220)
+    checks.append(all(abs(p - 0.25) < 1e-9 for p in belief.marginals().values()))
+    belief.reveal('monk')
+    marginals = belief.marginals()
+    checks.append(len(belief) == 55 and marginals['monk'] == 1.0)
+    checks.append(all(abs(marginals[v] - 2 / 11) < 1e-9 for v in POPULATION - {'monk'}))
+    checks.append(all('monk' in t and t <= POPULATION and len(t) == 3 for t in belief.sample(100)))
+    # Arrests that did not end the game
+    belief = AssassinsBelief()
+    belief.arrest(['monk', 'hooker', 'farmer'])
+    checks.append(len(belief) == 219 and 'monk' in belief.marginals())
+    checks.append(all(t != {'monk', 'hooker', 'farmer'} for t in belief.sample(1000)))
+    belief = AssassinsBelief()
+    belief.arrest(['monk', 'hooker'], 1)
+    checks.append(len(belief) == 210)
+    belief.clear('farmer')
+    checks.append(len(belief) == 210 - 54 and belief.marginals()['farmer'] == 0.0)
+    # Movements towards the king
+    belief = AssassinsBelief()
+    belief.weigh('monk', 2.0)
+    marginals = belief.marginals()
+    checks.append(marginals['monk'] > marginals['hooker'] and abs(sum(marginals.values()) - 3) < 1e-9)
+    # Observations of a game
+    visible = copy.deepcopy(KA_INITIAL_STATE)
+    visible['people'] = [[None] * 10 for x in range(10)]
+    visible['people'][9][9] = 'king'
+    for villager, (x, y) in zip(sorted(POPULATION), sorted(VILLAGERS)):
+        visible['people'][x][y] = villager
+    belief = AssassinsBelief()
+    belief.observe(visible)
+    x, y = sorted(VILLAGERS)[0]
+    visible['people'][x][y] = 'assassin'
+    belief.observe(visible)
+    checks.append(len(belief) == 55 and belief.marginals()[sorted(POPULATION)[0]] == 1.0)
+    x, y = sorted(VILLAGERS)[1]
+    visible['people'][x][y] = None
+    belief.observe(visible)
+    checks.append(len(belief) == 55)
+    # Villager moving then revealed in the same turn
+    x, y = sorted(VILLAGERS)[2]
+    visible['people'][x][y] = None
+    visible['people'][x + 1][y] = 'assassin'
+    belief.observe(visible)
+    checks.append(len(belief) == 10 and belief.marginals()[sorted(POPULATION)[2]] == 1.0)
+    # Contradictory evidence
+    belief.clear(sorted(POPULATION)[0])
+    checks.append(len(belief) == 0 and len(belief.sample(5)) == 5 and belief._alive == full)
+    for i, check in enumerate(checks):
+        assert check, 'check {} failed'.format(i)
+    return len(checks)
+
+
+class OpeningBook:
+    '''Class representing an opening book stored in a memory-mapped file.
+
+    The file contains a header with the number of entries, the players the
+    book has moves for and the number of turns it covers, the (key, offset,
+    length) records sorted by key, and then the moves they point to. Being
+    read-only and memory-mapped, it is shared by all the clients of a host.
+    '''
+
+    MAGIC = b'KAOB'
+    HEADER = struct.Struct('<4sIBB')
+    RECORD = struct.Struct('<QII')
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._size, self._players, self._turns = OpeningBook.HEADER.unpack_from(self._map, 0)
+        if magic != OpeningBook.MAGIC:
+            raise ValueError('{}: not an opening book'.format(path))
+
+    def __len__(self):
+        return self._size
+
+    def covers(self, player, turn):
+        '''Check whether the book may have a move for the turn of a player.
+
+        Pre: 'turn' is the number of the turn of 'player', starting from 1.
+        Post: The returned value is False if the book cannot contain the move,
+              so that a client does not compute the key of the position.
+        '''
+        return bool(self._players >> player & 1) and turn <= self._turns
+
+    def close(self):
+        self._map.close()
+
+    @staticmethod
+    def key(player, visible):
+        '''Get the key of a position.
+
+        Pre: 'visible' is the visible part of a state where 'player' has to play.
+        Post: The returned value is a 64-bit digest of the player, the card drawn
+              and the people on the board. The villagers are shuffled on their cells
+              in every process (see PEOPLE), so that their names are ignored for
+              player 1: keys with names would never match a book built elsewhere.
+        '''
+        people = visible['people']
+        if player == 1:
+            people = [['villager' if p in POPULATION else p for p in row] for row in people]
+        data = json.dumps([player, visible['card'], people], separators=(',', ':'))
+        return int.from_bytes(hashlib.blake2b(data.encode(), digest_size=8).digest(), 'little')
+
+    def lookup(self, player, visible):
+        '''Get the move to play in a position.
+
+        Pre: 'visible' is the visible part of a state where 'player' has to play.
+        Post: The returned value is the move stored in the book, or None if the
+              position is not in the book.
+        '''
+        key = OpeningBook.key(player, visible)
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            k, offset, length = OpeningBook.RECORD.unpack_from(
+                self._map, OpeningBook.HEADER.size + middle * OpeningBook.RECORD.size
+            )
+            if k < key:
+                low = middle + 1
+            elif k > key:
+                high = middle
+            else:
+                return self._map[offset:offset+length].decode()
+        return None
+
+    @staticmethod
+    def write(path, moves, players, turns):
+        '''Write an opening book.
+
+        Pre: 'moves' is a dictionary mapping keys of positions to moves, played by
+             'players' during their first 'turns' turns.
+        Post: The book has been written in the file 'path'.
+        '''
+        keys = sorted(moves)
+        offset = OpeningBook.HEADER.size + len(keys) * OpeningBook.RECORD.size
+        records, data = [], []
+        for key in keys:
+            move = moves[key].encode()
+            records.append(OpeningBook.RECORD.pack(key, offset, len(move)))
+            data.append(move)
+            offset += len(move)
+        with open(path, 'wb') as file:
+            players = sum(1 << player for player in players)
+            file.write(OpeningBook.HEADER.pack(OpeningBook.MAGIC, len(keys), players, turns))
+            file.write(b''.join(records))
+            file.write(b''.join(data))
+
+    @staticmethod
+    def build(path):
+        '''Build the opening book of the king's first move with every card.
+
+        Pre: -
+        Post: The book has been written in the file 'path' and the returned value
+              is its number of entries. As ouverture_roi does not depend on the
+              card yet, all the entries currently hold the same move.
+        '''
+        moves = {}
+        for card in set(CARDS):
+            visible = copy.deepcopy(KA_INITIAL_STATE)
+            visible['card'] = card
+            moves[OpeningBook.key(1, visible)] = json.dumps({'actions': ouverture_roi(visible)}, separators=(',', ':'))
+        OpeningBook.write(path, moves, {1}, 1)
+        return len(moves)
+
+
+def ouverture_roi(visible):
+    '''Get the opening move of the king's team.
+
+    Pre: 'visible' is the visible part of a state where player 1 has to play.
+    Post: The returned value is the list of actions setting up the protection of
+          the king if he is still on (9, 9), None otherwise.
+    '''
+    if visible['people'][9][9] != 'king':
+        return None
+    return [('move', 9, 8, 'W'), ('move', 9, 9, 'W'), ('move', 8, 9, 'S'), ('move', 8, 7, 'N')]
+
+
 class KingAndAssassinsClient(game.GameClient):
     '''Class representing a client for the King & Assassins game'''
 
-    def __init__(self, name, server, verbose=False):
-        super().__init__(server, KingAndAssassinsState, verbose=verbose)
+    def __init__(self, name, server, verbose=False, book=None):
+        self.belief = AssassinsBelief()
+        self._book = None if book is None else OpeningBook(book)
+        self._turn = 0
+        # The game is played by GameClient.__init__
+        try:
+            super().__init__(server, KingAndAssassinsState, verbose=verbose)
+        finally:
+            if self._book is not None:
+                self._book.close()
         self.__name = name
 
     def _handle(self, message):
@@ -313,11 +660,9 @@ class KingAndAssassinsClient(game.GameClient):
 
     def strat_roi(self,state):
         self.depl={'action':[],'PA_caval':self.state['card'][1]}     
-        if self.pos_roi(self.state)[0]==9 and self.pos_roi(self.state)[1]==9:   #au premier coup mise en place de la stratégie
-            self.depl['action'].append(('move',9,8,'W'))
-            self.depl['action'].append(('move',9,9,'W'))
-            self.depl['action'].append(('move',8,9,'S'))
-            self.depl['action'].append(('move',8,7,'N'))
+        ouverture=ouverture_roi(self.state)
+        if ouverture is not None:   #au premier coup mise en place de la stratégie
+            self.depl['action'].extend(ouverture)
             self.depl['PA_caval']-=2
         else:       #deplacement horizontal du roi et puis vertical
             if self.pos_roi(self.state)[1]==2:  #si le roi est dans la deuxieme colonne, deplacement vers le nord
@@ -414,6 +759,14 @@ class KingAndAssassinsClient(game.GameClient):
         #   ('attack', x, y, dir): attacks the king in direction dir with assassin at position (x, y)
         #   ('reveal', x, y): reveals villager at position (x,y) as an assassin
         self.state = state._state['visible']
+        self._turn += 1
+        if self._playernb == 1:
+            self.belief.observe(self.state)
+        # Known positions of the opening are played from the book, without any search
+        if self._book is not None and self._book.covers(self._playernb, self._turn):
+            move = self._book.lookup(self._playernb, self.state)
+            if move is not None:
+                return move
         if self.state['card'] is None:
             return json.dumps({'assassins': ['monk', 'hooker', 'fishwoman']}, separators=(',', ':'))
         else:
@@ -431,7 +784,7 @@ if __name__ == '__main__':
     # Create the top-level parser
     parser = argparse.ArgumentParser(description='King & Assassins game')
     subparsers = parser.add_subparsers(
-        description='server client',
+        description='server client check book',
         help='King & Assassins game components',
         dest='component'
     )
@@ -447,12 +800,22 @@ if __name__ == '__main__':
     client_parser.add_argument('--host', help='hostname of the server (default: localhost)',
                                default=socket.gethostbyname(socket.gethostname()))
     client_parser.add_argument('--port', help='port of the server (default: 5000)', default=5000)
+    client_parser.add_argument('--book', help='opening book to play from (default: none)', default=None)
     client_parser.add_argument('-v', '--verbose', action='store_true')
+    # Create the parser for the 'check' subcommand
+    subparsers.add_parser('check', help='check the belief about the assassins')
+    # Create the parser for the 'book' subcommand
+    book_parser = subparsers.add_parser('book', help='build an opening book')
+    book_parser.add_argument('path', help='file to write the opening book to')
     # Parse the arguments of sys.args
     args = parser.parse_args()
 
     if args.component == 'server':
         KingAndAssassinsServer(verbose=args.verbose).run()
+    elif args.component == 'check':
+        print('{} checks of AssassinsBelief passed.'.format(checkbelief()))
+    elif args.component == 'book':
+        print('{} positions written to {}.'.format(OpeningBook.build(args.path), args.path))
     else:
-        KingAndAssassinsClient(args.name, (args.host, args.port), verbose=args.verbose)
+        KingAndAssassinsClient(args.name, (args.host, args.port), verbose=args.verbose, book=args.book)
         
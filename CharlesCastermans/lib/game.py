@@ -65,10 +65,12 @@ class GameState(metaclass=ABCMeta):
 
 class GameServer(metaclass=ABCMeta):
     '''Abstract class representing a generic game server.'''
-    def __init__(self, name, nbplayers, initialstate, verbose=False):
+    def __init__(self, name, nbplayers, initialstate, verbose=False, host=None, port=5000):
         self.__name = name
         self.__nbplayers = nbplayers
         self.__verbose = verbose
+        self.__host = socket.gethostbyname(socket.gethostname()) if host is None else host
+        self.__port = port
         self._state = initialstate
         # Stats about the running game
         self.__currentplayer = None
@@ -107,11 +109,11 @@ class GameServer(metaclass=ABCMeta):
     def _waitplayers(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((socket.gethostbyname(socket.gethostname()), 5000))
+        s.bind((self.__host, self.__port))
         s.listen(self.nbplayers)
         if self.__verbose:
             _printsection('Starting {}'.format(self.name))
-            print(' Game server listening on {}:{}.'.format(socket.gethostbyname(socket.gethostname()), 5000))
+            print(' Game server listening on {}:{}.'.format(self.__host, self.__port))
             print(' Waiting for {} players...'.format(self.nbplayers))
         self.__players = []
         # Wait for enough players for a play
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# loadtest.py
+# Load generator for the King & Assassins game server
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+
+import kingandassassins as ka
+
+THINKTIMES = {
+    'none': lambda rng, mean: 0,
+    'constant': lambda rng, mean: mean,
+    'uniform': lambda rng, mean: rng.uniform(0, 2 * mean),
+    'exponential': lambda rng, mean: rng.expovariate(1 / mean) if mean > 0 else 0
+}
+
+
+def _serve(host, port, nbservers, bindfailures):
+    '''Run 'nbservers' game servers forever, each one on its own port.'''
+    def loop(port):
+        backoff = 0.1
+        while True:
+            server = ka.KingAndAssassinsServer(host=host, port=port)
+            try:
+                server.run()
+                backoff = 0.1
+            except OSError as e:
+                # Players that left in the middle of a game
+                if server.currentplayer is not None:
+                    continue
+                # The server could not listen on its port
+                with bindfailures.get_lock():
+                    bindfailures.value += 1
+                print('Server on port {}: {}'.format(port, e), file=sys.stderr)
+                time.sleep(backoff)
+                backoff = min(2 * backoff, 5)
+    # Keep the stdout of the caller for the report
+    sys.stdout = open(os.devnull, 'w')
+    for i in range(nbservers):
+        threading.Thread(target=loop, args=(port + i,), daemon=True).start()
+    threading.Event().wait()
+
+
+def _percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class _Match:
+    '''Class representing one game played by two bots.'''
+    def __init__(self):
+        self.sent = None
+        self.abandoned = False
+
+
+class LoadGenerator:
+    '''Class representing a load generator for King & Assassins game servers.
+
+    Every slot is a game server listening on its own port and a pair of asyncio
+    bots playing games against it in a loop. Bots send the assassins' choice
+    then empty actions, so that a game lasts until the cards run out.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=5000, slots=100, duration=10,
+                 think='none', thinkmean=0, churn=0, timeout=10, seed=None):
+        self.host = host
+        self.port = port
+        self.slots = slots
+        self.duration = duration
+        self.think = THINKTIMES[think]
+        self.thinkmean = thinkmean
+        self.churn = churn
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        # Stats about the run
+        self.connects = []
+        self.latencies = []
+        self.moves = 0
+        self.games = 0
+        self.abandoned = 0
+        self.failed = 0
+        self.errors = {}
+
+    async def _connect(self, port):
+        deadline = time.perf_counter() + self.timeout
+        while True:
+            try:
+                return await asyncio.open_connection(self.host, port)
+            except OSError:
+                # The server is still busy with the previous game
+                if time.perf_counter() > deadline:
+                    raise
+                await asyncio.sleep(0.01)
+
+    async def _play(self, port, match):
+        start = time.perf_counter()
+        reader, writer = await self._connect(port)
+        try:
+            while True:
+                data = (await asyncio.wait_for(reader.read(ka.BUFFER_SIZE), self.timeout)).decode()
+                now = time.perf_counter()
+                if data == '':
+                    if match.abandoned:
+                        return
+                    raise ConnectionError('connection closed by the server')
+                command = data[:data.index(' ')] if ' ' in data else data
+                if command in ('PLAY', 'WON', 'LOST', 'END') and match.sent is not None:
+                    self.latencies.append(now - match.sent)
+                    match.sent = None
+                if command == 'START':
+                    self.connects.append(now - start)
+                    writer.write('READY loadtest'.encode())
+                elif command == 'PLAY':
+                    state = json.loads(data[data.index(' ')+1:])
+                    await asyncio.sleep(self.think(self.rng, self.thinkmean))
+                    if match.abandoned:
+                        return
+                    if self.rng.random() < self.churn:
+                        match.abandoned = True
+                        return
+                    if state['card'] is None:
+                        move = {'assassins': self.rng.sample(sorted(ka.POPULATION), 3)}
+                    else:
+                        move = {'actions': []}
+                    match.sent = time.perf_counter()
+                    writer.write(json.dumps(move, separators=(',', ':')).encode())
+                    await writer.drain()
+                    self.moves += 1
+                elif command in ('WON', 'LOST', 'END'):
+                    return
+                else:
+                    raise ValueError('unexpected message: {}'.format(command))
+        except OSError:
+            # The opponent left the game on purpose
+            if not match.abandoned:
+                raise
+        finally:
+            writer.close()
+
+    async def _slot(self, port, deadline):
+        while time.perf_counter() < deadline:
+            match = _Match()
+            results = await asyncio.gather(self._play(port, match), self._play(port, match),
+                                           return_exceptions=True)
+            errors = [e for e in results if isinstance(e, BaseException)]
+            if len(errors) > 0:
+                self.failed += 1
+            elif match.abandoned:
+                self.abandoned += 1
+            else:
+                self.games += 1
+            for e in errors:
+                name = type(e).__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+            if len(errors) > 0:
+                # Leave some time to the server to give up the game
+                await asyncio.sleep(0.1)
+
+    async def _slots(self, deadline):
+        await asyncio.gather(*[self._slot(self.port + i, deadline) for i in range(self.slots)])
+
+    def run(self):
+        '''Run the load test.
+
+        Pre: -
+        Post: The returned value is a dictionary with the throughput, the latency
+              percentiles (in milliseconds), the errors of the bots by type, the
+              number of failed binds of the servers and the error rate of the run
+              (games with at least one error over all the games played).
+        '''
+        bindfailures = multiprocessing.Value('i', 0)
+        servers = multiprocessing.Process(target=_serve, args=(self.host, self.port, self.slots, bindfailures),
+                                          daemon=True)
+        servers.start()
+        try:
+            start = time.perf_counter()
+            deadline = start + self.duration
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self._slots(deadline))
+            finally:
+                loop.close()
+            elapsed = time.perf_counter() - start
+        finally:
+            servers.terminate()
+            servers.join()
+        latencies = sorted(self.latencies)
+        connects = sorted(self.connects)
+        played = self.games + self.abandoned + self.failed
+        return {
+            'elapsed': elapsed,
+            'games': self.games,
+            'abandoned': self.abandoned,
+            'failed': self.failed,
+            'moves': self.moves,
+            'games/s': self.games / elapsed,
+            'moves/s': self.moves / elapsed,
+            'latency': {
+                'p50': 1000 * _percentile(latencies, 50),
+                'p90': 1000 * _percentile(latencies, 90),
+                'p99': 1000 * _percentile(latencies, 99),
+                'max': 1000 * (latencies[-1] if len(latencies) > 0 else 0.0)
+            },
+            'connect': {
+                'p50': 1000 * _percentile(connects, 50),
+                'p99': 1000 * _percentile(connects, 99)
+            },
+            'errors': dict(self.errors),
+            'bindfailures': bindfailures.value,
+            'errorrate': self.failed / played if played > 0 else 0.0
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for the King & Assassins game server')
+    parser.add_argument('--host', help='hostname to test on (default: 127.0.0.1)', default='127.0.0.1')
+    parser.add_argument('--port', help='first port of the servers (default: 5000)', type=int, default=5000)
+    parser.add_argument('--slots', help='number of concurrent games (default: 100)', type=int, default=100)
+    parser.add_argument('--duration', help='duration of the test in seconds (default: 10)', type=float, default=10)
+    parser.add_argument('--think', help='think-time distribution (default: none)',
+                        choices=sorted(THINKTIMES), default='none')
+    parser.add_argument('--think-mean', help='mean think time in seconds (default: 0)', type=float, default=0)
+    parser.add_argument('--churn', help='probability for a bot to leave the game at each turn (default: 0)',
+                        type=float, default=0)
+    parser.add_argument('--timeout', help='timeout of the bots in seconds (default: 10)', type=float, default=10)
+    parser.add_argument('--seed', help='seed of the bots', type=int, default=None)
+    args = parser.parse_args()
+
+    report = LoadGenerator(
+        args.host, args.port, args.slots, args.duration, args.think, args.think_mean,
+        args.churn, args.timeout, args.seed
+    ).run()
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# vecenv.py
+# Batched simulation of many King & Assassins games in lockstep
+
+import argparse
+import contextlib
+import copy
+import io
+import random
+
+import kingandassassins as ka
+
+# Codes of the pawns in the people grids
+PIECES = (None, 'king', 'knight', 'assassin') + tuple(sorted(ka.POPULATION))
+CODES = {piece: code for code, piece in enumerate(PIECES)}
+KING, KNIGHT, ASSASSIN = CODES['king'], CODES['knight'], CODES['assassin']
+FIRSTVILLAGER = CODES[PIECES[4]]
+
+# Status of the king
+KINGSTATUS = ('healthy', 'injured', 'dead')
+
+ROOFS = bytes(1 if ka.BOARD[x][y] == 'R' else 0 for x in range(10) for y in range(10))
+DOORS = tuple(10 * (x + ka.KingAndAssassinsState.DIRECTIONS[d][0]) + y + ka.KingAndAssassinsState.DIRECTIONS[d][1]
+              for x, y, d in ka.KA_INITIAL_STATE['castle'])
+DECKSIZE = len(ka.CARDS)
+
+
+class _Invalid(Exception):
+    '''Exception representing an action rejected by the rules.'''
+    pass
+
+
+def _cell(x, y):
+    # Same cells as people[x][y], negative indices included
+    if not (-10 <= x < 10 and -10 <= y < 10):
+        raise _Invalid()
+    return 10 * (x % 10) + y % 10
+
+
+def _getcoord(x, y, d):
+    if d not in ka.KingAndAssassinsState.DIRECTIONS:
+        raise _Invalid()
+    dx, dy = ka.KingAndAssassinsState.DIRECTIONS[d]
+    return x + dx, y + dy
+
+
+class KingAndAssassinsBatch:
+    '''Class representing N King & Assassins games played in lockstep.
+
+    The games are stored in flat byte arrays (100 cells per people grid, one
+    byte per king status, card, player, ...) and stepped in one call. Games
+    follow KingAndAssassinsState.update and winner(), including the way the
+    server deals with invalid moves: the actions applied before the invalid one
+    are kept, no card is drawn and the same player plays again.
+
+    Known bugs of the reference are reproduced as well, so beware of them when
+    learning from these games:
+    - a knight can never push villagers ('_nextfree' is called with a single
+      tuple, so that every push is rejected);
+    - a kill empties the cell people[tx][tx] instead of the target's cell: the
+      killed pawn stays on the board and another pawn may disappear instead;
+    - the doors of the castle are on roofs, where the king cannot move.
+    '''
+
+    def __init__(self, n):
+        self.n = n
+        self.people = bytearray(100 * n)
+        self.king = bytearray(n)
+        self.card = bytearray(n)
+        self.deck = bytearray(DECKSIZE * n)
+        self.remaining = bytearray(n)
+        self.player = bytearray(n)
+        self.assassins = [0] * n
+        self.arrested = bytearray(len(ka.POPULATION) * n)
+        self.nbarrested = bytearray(n)
+        self.killed = bytearray(2 * n)
+        self.done = bytearray(n)
+
+    def reset(self, seeds, games=None):
+        '''Start a new game in some slots of the batch.
+
+        Pre: 'games' are indices of games (all the games if None) and
+             len(seeds) == len(games)
+        Post: Game games[i] has been set up from seeds[i] (villagers, deck and
+              assassins), its first card has been drawn and player 1 has to play;
+              the other games are left as they are.
+              The returned value contains the observations.
+        '''
+        villagers = sorted(ka.VILLAGERS)
+        if games is None:
+            games = range(self.n)
+        for g, seed in zip(games, seeds):
+            rng = random.Random(seed)
+            people = bytearray(100)
+            people[99] = KING
+            for x, y in ka.KNIGHTS:
+                people[10 * x + y] = KNIGHT
+            for villager, (x, y) in zip(rng.sample(sorted(ka.POPULATION), len(ka.POPULATION)), villagers):
+                people[10 * x + y] = CODES[villager]
+            self.people[100 * g:100 * (g + 1)] = people
+            self.deck[DECKSIZE * g:DECKSIZE * (g + 1)] = bytes(rng.sample(range(DECKSIZE), DECKSIZE))
+            self.assassins[g] = sum(1 << (CODES[a] - FIRSTVILLAGER)
+                                    for a in rng.sample(sorted(ka.POPULATION), 3))
+            # Choosing the assassins draws the first card
+            self.remaining[g] = DECKSIZE - 1
+            self.card[g] = self.deck[DECKSIZE * g + DECKSIZE - 1]
+            self.king[g] = 0
+            self.player[g] = 1
+            self.arrested[len(ka.POPULATION) * g:len(ka.POPULATION) * (g + 1)] = bytes(len(ka.POPULATION))
+            self.nbarrested[g] = 0
+            self.killed[2 * g:2 * g + 2] = b'\x00\x00'
+            self.done[g] = 0
+        return self.observations()
+
+    def observations(self):
+        return {
+            'people': bytes(self.people),
+            'king': bytes(self.king),
+            'card': bytes(self.card),
+            'player': bytes(self.player),
+            'arrested': bytes(self.arrested),
+            'nbarrested': bytes(self.nbarrested),
+            'killed': bytes(self.killed),
+            'remaining': bytes(self.remaining)
+        }
+
+    def _apply(self, g, move, player):
+        people = 100 * g
+        if move[0] == 'move':
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            c = people + _cell(x, y)
+            p = self.people[c]
+            if p == 0:
+                raise _Invalid()
+            nx, ny = _getcoord(x, y, d)
+            nc = _cell(nx, ny)
+            new = self.people[people + nc]
+            if p != KNIGHT and new != 0:
+                raise _Invalid()
+            if p == KING and ROOFS[nc]:
+                raise _Invalid()
+            if p == ASSASSIN or p >= FIRSTVILLAGER and player != 0:
+                raise _Invalid()
+            if p in (KING, KNIGHT) and player != 1:
+                raise _Invalid()
+            # Reference bug: pushing villagers is never accepted
+            if new != 0:
+                raise _Invalid()
+            self.people[c], self.people[people + nc] = 0, p
+        elif move[0] == 'arrest':
+            if player != 1:
+                raise _Invalid()
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            if self.people[people + _cell(x, y)] != KNIGHT:
+                raise _Invalid()
+            tx, ty = _getcoord(x, y, d)
+            tc = people + _cell(tx, ty)
+            if self.people[tc] < FIRSTVILLAGER:
+                raise _Invalid()
+            self.arrested[len(ka.POPULATION) * g + self.nbarrested[g]] = self.people[tc]
+            self.nbarrested[g] += 1
+            self.people[tc] = 0
+        elif move[0] == 'kill':
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            killer = self.people[people + _cell(x, y)]
+            if killer == ASSASSIN and player != 0:
+                raise _Invalid()
+            if killer == KNIGHT and player != 1:
+                raise _Invalid()
+            tx, ty = _getcoord(x, y, d)
+            target = self.people[people + _cell(tx, ty)]
+            if target == 0:
+                raise _Invalid()
+            if killer == ASSASSIN and target == KNIGHT:
+                self.killed[2 * g] += 1
+            elif killer == KNIGHT and target == ASSASSIN:
+                self.killed[2 * g + 1] += 1
+            else:
+                raise _Invalid()
+            # Reference bug: people[tx][tx] is emptied, not the target's cell
+            self.people[people + _cell(tx, tx)] = 0
+        elif move[0] == 'attack':
+            if player != 0:
+                raise _Invalid()
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            if self.people[people + _cell(x, y)] != ASSASSIN:
+                raise _Invalid()
+            tx, ty = _getcoord(x, y, d)
+            if self.people[people + _cell(tx, ty)] != KING:
+                raise _Invalid()
+            self.king[g] = 1 if self.king[g] == 0 else 2
+        elif move[0] == 'reveal':
+            if player != 0:
+                raise _Invalid()
+            x, y = int(move[1]), int(move[2])
+            c = people + _cell(x, y)
+            p = self.people[c]
+            if p < FIRSTVILLAGER or not self.assassins[g] >> (p - FIRSTVILLAGER) & 1:
+                raise _Invalid()
+            self.people[c] = ASSASSIN
+
+    def winner(self, g):
+        '''Get the winner of game g, as KingAndAssassinsState.winner does.'''
+        people = 100 * g
+        for door in DOORS:
+            if 0 <= door < 100 and self.people[people + door] == KING:
+                return 1
+        if self.remaining[g] == 0:
+            return 0
+        if self.king[g] == 2:
+            return 0
+        arrested = 0
+        for code in self.arrested[len(ka.POPULATION) * g:len(ka.POPULATION) * g + self.nbarrested[g]]:
+            arrested |= 1 << (code - FIRSTVILLAGER)
+        if self.killed[2 * g + 1] + bin(arrested & self.assassins[g]).count('1') == 3:
+            return 1
+        return -1
+
+    def step(self, actions):
+        '''Play one move in every game that is still going on.
+
+        Pre: len(actions) == self.n and actions[i] is the list of actions of the
+             player to play in game i (None to skip game i).
+        Post: The returned value contains the observations, the rewards of the
+              players who just played (1 won, -1 lost, 0 otherwise), the done
+              flags and the invalid flags of the games.
+        '''
+        rewards = [0] * self.n
+        invalid = bytearray(self.n)
+        for g, moves in enumerate(actions):
+            if moves is None or self.done[g]:
+                continue
+            player = self.player[g]
+            try:
+                for move in moves:
+                    self._apply(g, move, player)
+                if player == 0:
+                    if self.remaining[g] == 0:
+                        raise _Invalid()
+                    self.remaining[g] -= 1
+                    self.card[g] = self.deck[DECKSIZE * g + self.remaining[g]]
+                self.player[g] = 1 - player
+            except (_Invalid, LookupError, TypeError, ValueError):
+                invalid[g] = 1
+            winner = self.winner(g)
+            if winner != -1:
+                self.done[g] = 1
+                rewards[g] = 1 if winner == player else -1
+        return self.observations(), rewards, bytes(self.done), bytes(invalid)
+
+    def load(self, g, state, player):
+        '''Set game g to a KingAndAssassinsState where 'player' has to play.'''
+        visible, hidden = state._state['visible'], state._state['hidden']
+        for x in range(10):
+            for y in range(10):
+                self.people[100 * g + 10 * x + y] = CODES[visible['people'][x][y]]
+        self.king[g] = KINGSTATUS.index(visible['king'])
+        self.card[g] = ka.CARDS.index(tuple(visible['card']))
+        for i, card in enumerate(hidden['cards']):
+            self.deck[DECKSIZE * g + i] = ka.CARDS.index(tuple(card))
+        self.remaining[g] = len(hidden['cards'])
+        self.player[g] = player
+        self.assassins[g] = sum(1 << (CODES[a] - FIRSTVILLAGER) for a in hidden['assassins'])
+        self.arrested[len(ka.POPULATION) * g:len(ka.POPULATION) * (g + 1)] = bytes(len(ka.POPULATION))
+        for i, villager in enumerate(visible['arrested']):
+            self.arrested[len(ka.POPULATION) * g + i] = CODES[villager]
+        self.nbarrested[g] = len(visible['arrested'])
+        self.killed[2 * g] = visible['killed']['knights']
+        self.killed[2 * g + 1] = visible['killed']['assassins']
+        self.done[g] = 0
+        self.done[g] = 1 if self.winner(g) != -1 else 0
+
+    def state(self, g):
+        '''Get game g as a KingAndAssassinsState (hidden part included).'''
+        people = [[PIECES[self.people[100 * g + 10 * x + y]] for y in range(10)] for x in range(10)]
+        arrested = self.arrested[len(ka.POPULATION) * g:len(ka.POPULATION) * g + self.nbarrested[g]]
+        state = ka.KingAndAssassinsState({
+            'board': ka.BOARD,
+            'people': people,
+            'castle': [(2, 2, 'N'), (4, 1, 'W')],
+            'card': ka.CARDS[self.card[g]],
+            'king': KINGSTATUS[self.king[g]],
+            'lastopponentmove': [],
+            'arrested': [PIECES[code] for code in arrested],
+            'killed': {
+                'knights': self.killed[2 * g],
+                'assassins': self.killed[2 * g + 1]
+            }
+        })
+        state._state['hidden'] = {
+            'assassins': {PIECES[FIRSTVILLAGER + i] for i in range(len(ka.POPULATION)) if self.assassins[g] >> i & 1},
+            'cards': [ka.CARDS[i] for i in self.deck[DECKSIZE * g:DECKSIZE * g + self.remaining[g]]]
+        }
+        return state
+
+
+def _randomactions(rng, people, player):
+    mine = ('assassin',) + tuple(ka.POPULATION) if player == 0 else ('king', 'knight')
+    cells = [(x, y) for x in range(10) for y in range(10) if people[x][y] in mine]
+    actions = []
+    for i in range(rng.randrange(4)):
+        x, y = rng.choice(cells) if cells and rng.random() < 0.9 else (rng.randint(-1, 10), rng.randint(-1, 10))
+        kind = rng.choice(('move', 'move', 'move', 'arrest', 'kill', 'attack', 'reveal', 'pass'))
+        # Aim at a neighbour most of the time for the actions with a target
+        directions = [d for d, (dx, dy) in ka.KingAndAssassinsState.DIRECTIONS.items()
+                      if 0 <= x + dx < 10 and 0 <= y + dy < 10 and people[x + dx][y + dy] is not None]
+        if kind in ('arrest', 'kill', 'attack') and directions and rng.random() < 0.8:
+            d = rng.choice(directions)
+        else:
+            d = rng.choice('NSEWNSEWX')
+        actions.append([kind, x, y] if kind == 'reveal' else [kind, x, y, d])
+    return actions
+
+
+def _scenario(assassins=('appleman', 'blacksmith', 'butcher'), cards=ka.CARDS, **people):
+    # Villagers in alphabetical order on the sorted VILLAGERS cells, and the
+    # given pawns ('x_y': name) placed on the board
+    grid = [[None] * 10 for x in range(10)]
+    grid[9][9] = 'king'
+    for x, y in ka.KNIGHTS:
+        grid[x][y] = 'knight'
+    for villager, (x, y) in zip(sorted(ka.POPULATION), sorted(ka.VILLAGERS)):
+        grid[x][y] = villager
+    for cell, name in people.items():
+        x, y = map(int, cell[1:].split('_'))
+        grid[x][y] = name
+    state = ka.KingAndAssassinsState({
+        'board': ka.BOARD,
+        'people': grid,
+        'castle': [(2, 2, 'N'), (4, 1, 'W')],
+        'card': ka.CARDS[0],
+        'king': 'healthy',
+        'lastopponentmove': [],
+        'arrested': [],
+        'killed': {'knights': 0, 'assassins': 0}
+    })
+    state._state['hidden'] = {'assassins': set(assassins), 'cards': list(cards)}
+    return state
+
+
+# Targeted games: (name, state, player, actions, expected winner)
+SCENARIOS = (
+    ('king on a door', _scenario(c9_9=None, c4_0='king'), 1, [], 1),
+    ('king moving to a door', _scenario(c9_9=None, c4_1='king'), 1, [('move', 4, 1, 'W')], -1),
+    ('king killed', _scenario(c9_8='assassin'), 0, [('attack', 9, 8, 'E'), ('attack', 9, 8, 'E')], 0),
+    ('king injured', _scenario(c9_8='assassin'), 0, [('attack', 9, 8, 'E')], -1),
+    ('assassins arrested', _scenario(c1_6='knight', c2_2='knight', c3_3='knight'), 1,
+     [('arrest', 1, 6, 'E'), ('arrest', 2, 2, 'W'), ('arrest', 3, 3, 'E')], 1),
+    ('villagers arrested', _scenario(c1_6='knight', c2_2='knight', c5_1='knight'), 1,
+     [('arrest', 1, 6, 'E'), ('arrest', 2, 2, 'W'), ('arrest', 5, 1, 'E')], -1),
+    ('assassins killed and arrested', _scenario(c3_4='assassin', c3_3='knight', c1_6='knight', c2_2='knight'), 1,
+     [('kill', 3, 3, 'E'), ('arrest', 1, 6, 'E'), ('arrest', 2, 2, 'W')], 1),
+    ('assassin revealed', _scenario(), 0, [('reveal', 1, 7)], -1),
+    ('last card', _scenario(cards=ka.CARDS[:1]), 0, [], 0),
+    ('knight pushing', _scenario(c1_6='knight'), 1, [('move', 1, 6, 'E')], -1)
+)
+
+
+def _checkscenarios():
+    batch = KingAndAssassinsBatch(len(SCENARIOS))
+    for g, (name, state, player, actions, winner) in enumerate(SCENARIOS):
+        batch.load(g, state, player)
+    batch.step([actions for name, state, player, actions, winner in SCENARIOS])
+    for g, (name, state, player, actions, winner) in enumerate(SCENARIOS):
+        reference = ka.KingAndAssassinsState(copy.deepcopy(state._state['visible']))
+        reference._state['hidden'] = copy.deepcopy(state._state['hidden'])
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                reference.update(actions, player)
+        except Exception:
+            pass
+        assert reference.winner() == winner, '{}: unexpected winner of the reference'.format(name)
+        assert batch.winner(g) == winner, '{}: wrong winner'.format(name)
+        assert bool(batch.done[g]) == (winner != -1), '{}: wrong done flag'.format(name)
+        assert batch.state(g)._state == reference._state, '{}: the games differ'.format(name)
+    return len(SCENARIOS)
+
+
+def crossvalidate(n=100, steps=100, seed=0):
+    '''Check the batch against KingAndAssassinsState on targeted then random games.
+
+    The random games that end are restarted, alone, for the next steps.
+
+    Pre: -
+    Post: The returned value is the number of moves checked.
+    Raises AssertionError: If a game of the batch differs from the reference.
+    '''
+    checked = _checkscenarios()
+    rng = random.Random(seed)
+    batch = KingAndAssassinsBatch(n)
+    batch.reset([rng.random() for g in range(n)])
+    states = [batch.state(g) for g in range(n)]
+    players = [1] * n
+    winners = [-1] * n
+    for i in range(steps):
+        ended = [g for g in range(n) if winners[g] != -1]
+        if len(ended) > 0:
+            observations = batch.reset([rng.random() for g in ended], ended)
+            for g in ended:
+                states[g], players[g], winners[g] = batch.state(g), 1, -1
+                arrested = observations['arrested'][len(ka.POPULATION) * g:len(ka.POPULATION) * (g + 1)]
+                assert arrested == bytes(len(ka.POPULATION)), 'game {}: arrests left after reset'.format(g)
+        actions = [None if winners[g] != -1 else _randomactions(rng, states[g]._state['visible']['people'], players[g])
+                   for g in range(n)]
+        batch.step(actions)
+        for g in range(n):
+            if actions[g] is None:
+                continue
+            # Same as KingAndAssassinsServer.applymove and GameServer._gameloop
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    states[g].update(actions[g], players[g])
+                players[g] = 1 - players[g]
+            except Exception:
+                pass
+            winners[g] = states[g].winner()
+            assert batch.state(g)._state == states[g]._state, 'game {} differs at step {}'.format(g, i)
+            assert batch.player[g] == players[g], 'game {}: wrong player at step {}'.format(g, i)
+            assert bool(batch.done[g]) == (winners[g] != -1), 'game {}: wrong winner at step {}'.format(g, i)
+            checked += 1
+    return checked
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cross-validation of the batched King & Assassins games')
+    parser.add_argument('--games', help='number of games (default: 100)', type=int, default=100)
+    parser.add_argument('--steps', help='number of steps (default: 100)', type=int, default=100)
+    parser.add_argument('--seed', help='seed of the random games (default: 0)', type=int, default=0)
+    args = parser.parse_args()
+
+    print('{} moves checked against KingAndAssassinsState.'.format(crossvalidate(args.games, args.steps, args.seed)))